@@ -0,0 +1,211 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import json
+import pathlib
+import itertools
+import trio
+
+# properties mirrored from property-change events
+OBSERVED_PROPERTIES = ["ab-loop-a", "ab-loop-b", "volume"]
+
+class MpvConnection(object):
+    """Persistent json ipc connection to an mpv --input-ipc-server socket
+
+    responses are matched to commands by request_id, the
+    connection is reopened on the next command if it drops
+
+    OBSERVED_PROPERTIES are kept in self.properties as mpv
+    reports changes, on_property_change is started in the
+    nursery as on_property_change(name, property, value)
+    """
+    def __init__(self, socket_path, nursery, timeout=2, name=None, on_property_change=None):
+        self.socket_path = str(socket_path)
+        self.nursery = nursery
+        self.timeout = timeout
+        self.name = name
+        self.on_property_change = on_property_change
+        self.properties = {}
+        self.sock = None
+        self.request_ids = itertools.count(1)
+        # request_id : [trio.Event, response]
+        self.pending = {}
+        self.connect_lock = trio.Lock()
+        self.send_lock = trio.Lock()
+
+    @property
+    def connected(self):
+        return self.sock is not None
+
+    async def connect(self):
+        async with self.connect_lock:
+            if self.sock is not None:
+                return
+            sock = trio.socket.socket(trio.socket.AF_UNIX, trio.socket.SOCK_STREAM)
+            try:
+                await sock.connect(self.socket_path)
+            except OSError:
+                sock.close()
+                raise
+            self.sock = sock
+            self.nursery.start_soon(self.read_messages, sock)
+            for observe_id, property_name in enumerate(OBSERVED_PROPERTIES, 1):
+                await self.request(("observe_property", observe_id, property_name))
+
+    def disconnect(self, sock=None):
+        if sock is None:
+            sock = self.sock
+        if sock is None:
+            return
+        if sock is self.sock:
+            self.sock = None
+            self.properties = {}
+            # wake anything waiting on a response
+            for pending in self.pending.values():
+                pending[0].set()
+        # closing the socket under the reader's recv would raise
+        # in the reader, shut it down and let the reader close it
+        try:
+            sock.shutdown(trio.socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    async def command(self, *args):
+        """Send a command, returns the response dict or None
+
+        retries once on a fresh connection if the socket
+        cannot be written or closes before responding
+        """
+        for attempt in range(2):
+            try:
+                await self.connect()
+                return await self.request(args)
+            except OSError as ex:
+                print("mpv ipc {0}: {1}".format(self.socket_path, ex))
+                self.disconnect()
+        return None
+
+    async def request(self, args):
+        request_id = next(self.request_ids)
+        pending = self.pending[request_id] = [trio.Event(), None]
+        message = json.dumps({"command" : list(args), "request_id" : request_id}) + "\n"
+        try:
+            async with self.send_lock:
+                await self.send(message.encode())
+            with trio.move_on_after(self.timeout):
+                await pending[0].wait()
+        finally:
+            del self.pending[request_id]
+
+        if pending[1] is None and not self.connected:
+            raise OSError("connection closed")
+        return pending[1]
+
+    async def send(self, data):
+        sock = self.sock
+        if sock is None:
+            raise OSError("connection closed")
+        while data:
+            sent = await sock.send(data)
+            data = data[sent:]
+
+    async def read_messages(self, sock):
+        buffer = b""
+        try:
+            while True:
+                data = await sock.recv(65536)
+                if not data:
+                    break
+                buffer += data
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    try:
+                        message = json.loads(line.decode())
+                    except ValueError:
+                        continue
+                    self.handle_message(message)
+        except (OSError, trio.ClosedResourceError):
+            pass
+        finally:
+            self.disconnect(sock)
+            sock.close()
+
+    def handle_message(self, message):
+        request_id = message.get("request_id")
+        if request_id in self.pending:
+            pending = self.pending[request_id]
+            pending[1] = message
+            pending[0].set()
+        elif "event" in message:
+            self.handle_event(message)
+
+    def handle_event(self, message):
+        if message["event"] == "property-change" and "name" in message:
+            # data is missing for unavailable properties
+            value = message.get("data")
+            self.properties[message["name"]] = value
+            if self.on_property_change is not None:
+                self.nursery.start_soon(self.on_property_change, self.name, message["name"], value)
+
+class MpvPool(object):
+    """Connections to mpv processes by ipc socket name"""
+    def __init__(self, socket_dir, nursery, on_property_change=None):
+        self.socket_dir = socket_dir
+        self.nursery = nursery
+        self.on_property_change = on_property_change
+        self.connections = {}
+
+    def connection(self, name):
+        if name not in self.connections:
+            socket_path = pathlib.PurePath(self.socket_dir, name)
+            self.connections[name] = MpvConnection(socket_path,
+                                                   self.nursery,
+                                                   name=name,
+                                                   on_property_change=self.on_property_change)
+        return self.connections[name]
+
+    async def wait_ready(self, name, timeout=5, interval=0.05):
+        """Wait until the ipc socket accepts a connection
+
+        returns False if it does not within timeout seconds
+        """
+        with trio.move_on_after(timeout):
+            while True:
+                try:
+                    await self.connection(name).connect()
+                    return True
+                except OSError:
+                    await trio.sleep(interval)
+        return False
+
+    async def command(self, name, *args):
+        return await self.connection(name).command(*args)
+
+    async def get_property(self, name, property_name):
+        response = await self.command(name, "get_property", property_name)
+        try:
+            return response["data"]
+        except (TypeError, KeyError):
+            return None
+
+    async def observed_property(self, name, property_name):
+        # mirrored value if mpv has reported one, otherwise ask
+        connection = self.connection(name)
+        if connection.connected and property_name in connection.properties:
+            return connection.properties[property_name]
+        return await self.get_property(name, property_name)
+
+    async def set_property(self, name, property_name, value):
+        response = await self.command(name, "set_property", property_name, value)
+        if response is not None and response.get("error") == "success" and property_name in OBSERVED_PROPERTIES:
+            # mirror the value now rather than when mpv reports it
+            self.connection(name).properties[property_name] = value
+        return response
+
+    def close(self, name):
+        connection = self.connections.pop(name, None)
+        if connection is not None:
+            connection.disconnect()
@@ -5,29 +5,157 @@
 # Copyright (c) 2018, Galen Curwen-McAdams
 
 import io
+import subprocess
 import numpy as np
-import matplotlib
-import matplotlib.pyplot as plt
-matplotlib.use('Agg')
+from PIL import Image
 import librosa
-import librosa.display
 
-def spectrogram_image(filename, image_filename=None, return_as_bytes=True, width=2, height=2):
+# matplotlib's magma (the colormap specshow uses for
+# negative db values) sampled at 17 evenly spaced points
+MAGMA = np.array([
+    [0.0015, 0.0005, 0.0139],
+    [0.0396, 0.0311, 0.1335],
+    [0.1131, 0.0655, 0.2768],
+    [0.2117, 0.0620, 0.4186],
+    [0.3167, 0.0717, 0.4854],
+    [0.4147, 0.1104, 0.5047],
+    [0.5128, 0.1482, 0.5076],
+    [0.6136, 0.1818, 0.4985],
+    [0.7164, 0.2150, 0.4753],
+    [0.8169, 0.2559, 0.4365],
+    [0.9043, 0.3196, 0.3881],
+    [0.9609, 0.4183, 0.3596],
+    [0.9867, 0.5356, 0.3822],
+    [0.9961, 0.6537, 0.4462],
+    [0.9969, 0.7696, 0.5349],
+    [0.9924, 0.8843, 0.6401],
+    [0.9871, 0.9914, 0.7495],
+])
+
+def colormap_lut(colors, size=256):
+    # interpolate colors into a size x 3 uint8 lookup table
+    positions = np.linspace(0, 1, len(colors))
+    samples = np.linspace(0, 1, size)
+    lut = np.stack([np.interp(samples, positions, colors[:, channel]) for channel in range(3)], axis=1)
+    return np.round(lut * 255).astype(np.uint8)
+
+MAGMA_LUT = colormap_lut(MAGMA)
+
+# streamed audio maps: pcm is decoded at SAMPLE_RATE and
+# analysed one block at a time, levels between DB_FLOOR and
+# 0 dB relative to full scale are spread over the lookup table
+SAMPLE_RATE = 22050
+BLOCK_SECONDS = 1
+N_FFT = 2048
+LOWEST_FREQUENCY = 40
+DB_FLOOR = -80
+
+def colormap_image(values, width, height, lut=MAGMA_LUT):
+    # map a 2d array to an rgb image, scaled between its min and
+    # max like matplotlib, row 0 is drawn at the bottom
+    values = np.asarray(values, dtype=np.float64)
+    low, high = np.min(values), np.max(values)
+    if high > low:
+        normalized = (values - low) / (high - low)
+    else:
+        normalized = np.zeros_like(values)
+    indices = np.round(normalized * (len(lut) - 1)).astype(np.intp)
+    image = Image.fromarray(lut[indices[::-1]], 'RGB')
+    return image.resize((width, height), Image.BILINEAR)
+
+def db_colors(db, lut=MAGMA_LUT):
+    # map decibels between DB_FLOOR and 0 to lut colors
+    normalized = np.clip((np.asarray(db) - DB_FLOOR) / -DB_FLOOR, 0, 1)
+    return lut[np.round(normalized * (len(lut) - 1)).astype(np.intp)]
+
+def pcm_blocks(filename, sample_rate=SAMPLE_RATE, block_seconds=BLOCK_SECONDS):
+    # yield mono float32 blocks of block_seconds decoded by
+    # ffmpeg to stdout so that only one block is held in memory,
+    # the last block may be shorter
+    block_bytes = int(sample_rate * block_seconds) * 2
+    process = subprocess.Popen(['ffmpeg',
+                                '-i',
+                                str(filename),
+                                '-vn',
+                                '-ac',
+                                '1',
+                                '-ar',
+                                str(sample_rate),
+                                '-f',
+                                's16le',
+                                '-'],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            block = process.stdout.read(block_bytes)
+            # drop a trailing odd byte
+            block = block[:len(block) - len(block) % 2]
+            if block:
+                yield np.frombuffer(block, dtype='<i2').astype(np.float32) / 32768
+            if len(block) < block_bytes:
+                break
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+
+def band_edges(bands, sample_rate=SAMPLE_RATE, n_fft=N_FFT):
+    # first stft bin of each of bands log spaced bands
+    # between LOWEST_FREQUENCY and nyquist
+    bins = n_fft // 2 + 1
+    lowest_bin = max(1, int(LOWEST_FREQUENCY * n_fft / sample_rate))
+    edges = np.floor(np.geomspace(lowest_bin, bins, bands + 1)[:-1]).astype(np.intp)
+    # low bands narrower than a bin are widened to one
+    # bin each so that every band has bins of its own
+    steps = np.arange(bands)
+    edges = np.maximum.accumulate(edges - steps) + steps
+    return np.minimum(edges, bins - 1)
+
+def block_spectrum(block, n_fft=N_FFT):
+    # mean power spectrum of non-overlapping windows, scaled
+    # so that a full scale sine sums to about 1 in its band
+    frames = max(1, -(-len(block) // n_fft))
+    padded = np.zeros(frames * n_fft, dtype=np.float32)
+    padded[:len(block)] = block
+    window = np.hanning(n_fft).astype(np.float32)
+    spectrum = np.abs(np.fft.rfft(padded.reshape((frames, n_fft)) * window, axis=1)) ** 2
+    return spectrum.mean(axis=0) / (window.sum() / 2) ** 2
+
+def block_maps(block, resolutions, edges):
+    # returns {resolution : (spectral colors, loudness colors)}
+    # each a uint8 array of shape (resolution, 3), spectral
+    # colors are band energies from low to high frequency and
+    # loudness colors the rms of resolution equal slices
+    spectrum = block_spectrum(block)
+    maps = {}
+    for resolution in resolutions:
+        band_power = np.add.reduceat(spectrum, edges[resolution])
+        spectral = db_colors(10 * np.log10(np.maximum(band_power, 1e-10)))
+        slices = np.array_split(block, resolution)
+        rms = np.array([np.sqrt(np.mean(np.square(s))) if len(s) else 0 for s in slices])
+        loudness = db_colors(20 * np.log10(np.maximum(rms, 1e-10)))
+        maps[resolution] = (spectral, loudness)
+    return maps
+
+def audio_maps(filename, resolutions, sample_rate=SAMPLE_RATE, block_seconds=BLOCK_SECONDS):
+    # yield block_maps for every block of the whole file
+    edges = {resolution : band_edges(resolution, sample_rate) for resolution in resolutions}
+    for block in pcm_blocks(filename, sample_rate, block_seconds):
+        yield block_maps(block, resolutions, edges)
+
+def spectrogram_image(filename, image_filename=None, return_as_bytes=True, width=200, height=200):
+    # width and height are in pixels
     time_series_array, sampling_rate = librosa.load(filename, offset=40, duration=10)
-    stft_matrix = librosa.stft(time_series_array)
-    rp = np.max(np.abs(stft_matrix))
-    #plt.figure(figsize=(2, 2))
-    fig = plt.figure(frameon=False)
-    fig.set_size_inches(width, height)
-    ax = fig.add_axes([0, 0, 1, 1])
-    ax.axis('off')
-    librosa.display.specshow(librosa.amplitude_to_db(stft_matrix, ref=rp), x_axis='log')
-    #librosa.display.specshow(librosa.amplitude_to_db(stft_matrix, ref=rp), y_axis='log')
+    stft_matrix = np.abs(librosa.stft(time_series_array))
+    rp = np.max(stft_matrix)
+    image = colormap_image(librosa.amplitude_to_db(stft_matrix, ref=rp), width, height)
     if return_as_bytes is True and image_filename is None:
-        image = io.BytesIO()
-        plt.savefig(image ,dp=1)
+        image_bytes = io.BytesIO()
+        image.save(image_bytes, "JPEG")
         image_bytes.seek(0)
-        return image
+        return image_bytes
     else:
-        plt.savefig(image_filename ,dp=1)
-        return image_filename
\ No newline at end of file
+        image.save(image_filename)
+        return image_filename
@@ -5,8 +5,12 @@
 # Copyright (c) 2018, Galen Curwen-McAdams
 
 import argparse
+import collections
+import concurrent.futures
+import itertools
 import pathlib
 import os
+import re
 import subprocess
 import io
 import uuid
@@ -14,6 +18,7 @@ import json
 from urllib.parse import urlparse
 import functools
 import hashlib
+import struct
 import time
 import trio
 import psutil
@@ -22,18 +27,68 @@ from xdg import (XDG_CACHE_HOME, XDG_CONFIG_HOME, XDG_DATA_HOME)
 import numpy as np
 from PIL import Image, ImageDraw, ImageShow
 import processors_audio
-
-# set to get entire numpy array as string
-# when using str(array)
-np.set_printoptions(threshold=np.inf)
+import watchers
+import mpv_ipc
 
 q = trio.Queue(1)
+# persistent ipc connections to loops, created in main
+mpv_pool = None
+# loops are reconciled as their keys change, with a
+# full sweep of every loop at most once per interval
+STATE_SWEEP_INTERVAL = 60
+last_state_sweep = None
+# longest blocking read of key events in seconds
+KEY_EVENT_READ_TIMEOUT = 1
+# loops started at the same time and seconds to
+# wait for a loop's ipc socket, limiter created in main
+SPAWN_LIMIT = 8
+SPAWN_TIMEOUT = 5
+spawn_limiter = None
+# sources are processed in a worker thread, one at a
+# time across directories, limiter created in main
+process_limiter = None
+# mpv property : loop field, reconciled one
+# loop at a time using a trio.Lock per loop uuid
+LOOP_PROPERTIES = {"ab-loop-a" : "start", "ab-loop-b" : "end", "volume" : "volume"}
+loop_locks = {}
 COLORMAP_RESOLUTIONS = [1, 4, 8, 16, 32]
 SERVER_ID = "vzz"
 VIZAVIZ_DATA_DIR = pathlib.PurePath(XDG_DATA_HOME, "vizaviz")
 VIZAVIZ_CONFIG_DIR = pathlib.PurePath(XDG_CONFIG_HOME, "vizaviz")
+VIZAVIZ_CACHE_DIR = pathlib.PurePath(XDG_CACHE_HOME, "vizaviz")
 VIZAVIZ_TEMP_DIR = pathlib.PurePath("/tmp")
 VIZAVIZ_FIFO_DIR = pathlib.PurePath("/tmp")
+# write extracted frames to VIZAVIZ_TEMP_DIR as bmp files
+# instead of reading them from ffmpeg's stdout
+FRAMES_TO_DISK = False
+# processes used for colormap extraction and the number
+# of frames queued for each process at a time
+WORKERS = os.cpu_count() or 1
+WORKER_FRAMES = 2
+# content hashing: sha1 keeps hashes compatible with existing
+# artifacts, blake2b is faster and sampled only reads the head,
+# middle and tail of each file
+HASH_ALGORITHMS = ["sha1", "blake2b", "sampled"]
+HASH_ALGORITHM = "sha1"
+HASH_CHUNK_SIZE = 1024 * 1024
+HASH_SAMPLE_SIZE = 4 * 1024 * 1024
+HASH_THREADS = 4
+# inotify watches source directories for new files,
+# poll rescans them every directory_check_interval
+WATCH_MODES = ["inotify", "poll"]
+WATCH_MODE = "inotify"
+# intermediate files of youtube-dl downloads
+YOUTUBE_DL_PARTIAL = re.compile(r"\.(f\d+|temp)\.mp4$")
+# binary colormap header: magic, frames, resolution, rgb values
+COLORMAP_MAGIC = b"VZZ1"
+COLORMAP_HEADER = struct.Struct("<4sIII")
+# colormaps are stored in redis in chunks of
+# frames, 600 is ten minutes at one frame per second
+COLORMAP_CHUNK_FRAMES = 600
+# colormap files kept memory mapped
+COLORMAP_OPEN_FILES = 64
+# maps created from the audio track for every resolution
+AUDIO_MAPS = ["spectral_map", "loudness_map"]
 
 # use feh instead of display for pillow .show()
 class FehViewer(ImageShow.UnixViewer):
@@ -57,19 +112,6 @@ def spawn_loop(file, loop_uuid):
                   "--keep-open=yes"])
     return p.pid
 
-def write_to_pipe(fifo_name, to_write):
-    print("writing to pipe: {}".format(to_write))
-    if not to_write.endswith("\n"):
-        to_write += "\n"
-    try:
-        output = subprocess.Popen(['socat', '-', pathlib.PurePath(VIZAVIZ_FIFO_DIR, fifo_name)], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        output.stdin.write(to_write.encode())
-        ostdout = output.communicate()[0]
-        output.stdin.close()
-        return ostdout.decode()
-    except:
-        return ""
-
 def loop_running(data):
     try:
         if not data['uuid'] in redis_conn.hgetall("vizaviz:{server_id}:state:running".format(server_id=SERVER_ID)).keys():
@@ -79,7 +121,7 @@ def loop_running(data):
     except KeyError:
         return False
 
-def idempotent_create_loop(name, data):
+async def idempotent_create_loop(name, data):
     spawn = True
     try:
         # do not try to spawn/respawn if loop is
@@ -90,102 +132,153 @@ def idempotent_create_loop(name, data):
         spawn = True
 
     if spawn:
-        data['pid'] = spawn_loop(data['filename'], data['uuid'])
-        redis_conn.hmset("vizaviz:{server_id}:state:running".format(server_id=SERVER_ID), { data['uuid'] : data['pid']})
-        redis_conn.hmset(name, {"pid" : data['pid']})
-        # use a slight delay to allow fifo to open
-        # so write_pipe commands will not initially fail
-        time.sleep(.75)
+        async with spawn_limiter:
+            data['pid'] = spawn_loop(data['filename'], data['uuid'])
+            redis_conn.hmset("vizaviz:{server_id}:state:running".format(server_id=SERVER_ID), { data['uuid'] : data['pid']})
+            redis_conn.hmset(name, {"pid" : data['pid']})
+            # drop any connection to a previous process
+            mpv_pool.close(data['uuid'])
+            # wait for the ipc socket to accept connections
+            # so that commands will not initially fail
+            if not await mpv_pool.wait_ready(data['uuid'], timeout=SPAWN_TIMEOUT):
+                print("loop {} ipc not ready after {}s".format(data['uuid'], SPAWN_TIMEOUT))
     return data
 
 async def get_state(redis_conn):
     print("getting state")
     # vizaviz:state:open [list of filenames]
     # vizaviz:state:close [list of fifo ids]
-    for key in redis_conn.scan_iter("vizaviz:{server_id}:loop:*".format(server_id=SERVER_ID)):
-        data = redis_conn.hgetall(key)
-        if not loop_running(data):
-            data = idempotent_create_loop(key, data)
-        try:
-            pid = int(redis_conn.hget("vizaviz:{server_id}:state:running".format(server_id=SERVER_ID), data['uuid']))
-            try:
-                proc = psutil.Process(pid)
-                print("pid: {0} status: {1}".format(pid, proc.status()))
-                if proc.status() == psutil.STATUS_ZOMBIE:
-                    idempotent_create_loop(key, data)
-            except psutil.NoSuchProcess:
-                idempotent_create_loop(key, data)
-        except:
-            # if pid is not successfully retrieved
-            data = idempotent_create_loop(key, data)
-
-        # check loop
-        # this seems to be spiking cpu usage
-        loop_start = write_to_pipe(data['uuid'], '{"command" : ["get_property","ab-loop-a"]}')
-        loop_end = write_to_pipe(data['uuid'], '{"command" : ["get_property","ab-loop-b"]}')
-        loop_volume = write_to_pipe(data['uuid'], '{"command" : ["get_property","volume"]}')
-        
-        # use loop volume to set on start
-        try:
+    global last_state_sweep
+    last_state_sweep = time.monotonic()
+    # reconcile loops concurrently, spawning is
+    # limited by spawn_limiter
+    async with trio.open_nursery() as nursery:
+        for key in redis_conn.scan_iter("vizaviz:{server_id}:loop:*".format(server_id=SERVER_ID)):
+            nursery.start_soon(reconcile_loop, redis_conn, key)
 
-            loop_start = json.loads(loop_start)['data']
-            loop_end = json.loads(loop_end)['data']
-            adjusted_loop = False
-            # ab-loop-a not yet set:
-            # {"data":"no","error":"success"}
+async def reconcile_loop(redis_conn, key):
+    data = redis_conn.hgetall(key)
+    if not data:
+        # deleted or not yet created
+        return
+    if not loop_running(data):
+        data = await idempotent_create_loop(key, data)
+    try:
+        pid = int(redis_conn.hget("vizaviz:{server_id}:state:running".format(server_id=SERVER_ID), data['uuid']))
+    except (KeyError, TypeError, ValueError):
+        # if pid is not successfully retrieved
+        pid = None
 
-            # ab-loop-a set:
-            # {"data":1.000000,"error":"success"}
-            print("ipc loop info: ", loop_start, (loop_start != float(data['start'])))
-            try:
-                if loop_start != float(data['start']) and float(data['start']) >= 0:
-                    write_to_pipe(data['uuid'], '{{"command" : ["set_property","ab-loop-a", {}]}}'.format(data['start']))
-                    adjusted_loop = True
-            except KeyError:
-                pass
+    if pid is None:
+        data = await idempotent_create_loop(key, data)
+    else:
+        try:
+            proc = psutil.Process(pid)
+            print("pid: {0} status: {1}".format(pid, proc.status()))
+            if proc.status() == psutil.STATUS_ZOMBIE:
+                await idempotent_create_loop(key, data)
+        except psutil.NoSuchProcess:
+            await idempotent_create_loop(key, data)
 
-            try:
-                if loop_end != float(data['end']) and float(data['end']) >= 0:
-                    write_to_pipe(data['uuid'], '{{"command" : ["set_property","ab-loop-b", {}]}}'.format(data['end']))
-            except KeyError:
-                pass
+    await reconcile_properties(data)
 
-            try:
-                if loop_volume != str(data['volume']):
-                    write_to_pipe(data['uuid'], '{{"command" : ["set_property","volume", {}]}}'.format(data['volume']))
-            except KeyError:
-                pass
+async def loop_property_changed(loop_id, property_name, value):
+    # mpv reported a change, set it back if it
+    # differs from the loop in redis
+    if property_name not in LOOP_PROPERTIES:
+        return
+    data = redis_conn.hgetall("vizaviz:{server_id}:loop:{loop_id}".format(server_id=SERVER_ID, loop_id=loop_id))
+    if data:
+        await reconcile_properties(data, [property_name])
+
+async def reconcile_properties(data, property_names=None):
+    # check loop against the state mirrored from mpv. reconciles
+    # of a loop run one at a time so that each sees the changes
+    # made by the previous one
+    if property_names is None:
+        property_names = list(LOOP_PROPERTIES)
+    lock = loop_locks.setdefault(data['uuid'], trio.Lock())
+    async with lock:
+        try:
+            adjusted_loop = False
+            for property_name in property_names:
+                field = LOOP_PROPERTIES[property_name]
+                try:
+                    value = float(data[field])
+                except KeyError:
+                    continue
+                # ab-loop-a not yet set:
+                # {"data":"no","error":"success"}
+                if property_name.startswith("ab-loop") and value < 0:
+                    continue
+                current = await mpv_pool.observed_property(data['uuid'], property_name)
+                if current != value:
+                    await mpv_pool.set_property(data['uuid'], property_name, value)
+                    if property_name == "ab-loop-a":
+                        adjusted_loop = True
 
             if adjusted_loop:
-                write_to_pipe(data['uuid'], '{{ "command": ["seek",{0},"absolute"]}}'.format(data['start']))
+                await mpv_pool.command(data['uuid'], "seek", float(data['start']), "absolute")
 
         except Exception as ex:
             print(ex)
 
 def audio_image_from_file(source, map_file_prefix=""):
     # 'spectrogram' should not be hardcoded
+    map_file = pathlib.PurePath(VIZAVIZ_DATA_DIR, 'map_image_spectrogram_{0}.jpg'.format(map_file_prefix))
+    if os.path.isfile(map_file):
+        print("already generated: {}".format(map_file))
+        return
     print("generating spectrogram for {}".format(source))
     try:
-        map_file = pathlib.PurePath(VIZAVIZ_DATA_DIR, 'map_image_spectrogram_{0}.jpg'.format(map_file_prefix))
         processors_audio.spectrogram_image(source, image_filename=str(map_file))
     except Exception as ex:
         print(ex)
 
-def images_to_db(map_file=None, map_file_prefix=""):
+def images_to_db(map_file=None, map_file_prefix="", db=None):
+    # upload the map images of source map_file_prefix, or of every
+    # source if no prefix is given. images are only written if
+    # their digest differs from the one stored alongside them.
+    # db can be a pipeline to batch the writes
+    if db is None:
+        db = redis_conn
     p = pathlib.Path(VIZAVIZ_DATA_DIR)
-    image_files = list(p.glob('map_image*.jpg'))
+    if map_file is not None:
+        image_files = [pathlib.Path(map_file)]
+    elif map_file_prefix:
+        image_files = list(p.glob('map_image_*_{}.jpg'.format(map_file_prefix)))
+    else:
+        image_files = list(p.glob('map_image*.jpg'))
+    source_images = {}
     for file in image_files:
         #map_image_spectrogram_11111
         _, _, map_name, map_file_prefix = file.stem.split("_")
         # for now set image_name to map_name
         image_name = map_name
-        image_bytes = io.BytesIO()
         with open(file, 'rb') as f:
-            image_bytes = io.BytesIO(f.read())
-        image_bytes.seek(0)
-        redis_conn.hmset("source:{}".format(map_file_prefix), {"map:{map_name}:image:{image_name}".format(map_name=map_name, image_name=image_name) : image_bytes.getvalue()})
+            image_bytes = f.read()
+        image_field = "map:{map_name}:image:{image_name}".format(map_name=map_name, image_name=image_name)
+        source_images.setdefault(map_file_prefix, {})[image_field] = image_bytes
+    # one write per source with changed images, digests
+    # are read from redis_conn since db may be a pipeline
+    for map_file_prefix, images in source_images.items():
+        source_key = "source:{}".format(map_file_prefix)
+        image_fields = list(images)
+        stored_digests = redis_conn.hmget(source_key, ["digest:{}".format(field) for field in image_fields])
+        fields = {}
+        for image_field, stored_digest in zip(image_fields, stored_digests):
+            image_digest = hashlib.sha1(images[image_field]).hexdigest()
+            if image_digest != stored_digest:
+                fields[image_field] = images[image_field]
+                fields["digest:{}".format(image_field)] = image_digest
+        if fields:
+            db.hmset(source_key, fields)
 
 def frames_from_file(source, destination, frame_file_prefix=""):
+    if not FRAMES_TO_DISK:
+        colormap_from_frames(frames_from_stream(source), frame_file_prefix)
+        return
+
     #fps=1/30'
     #1 per second
     os.makedirs(destination, exist_ok=True)
@@ -198,53 +291,261 @@ def frames_from_file(source, destination, frame_file_prefix=""):
                     ])
     p = pathlib.Path(destination)
     frame_files = list(p.glob('**/{}*.bmp'.format(frame_file_prefix)))
-    colormap_from_frames(frame_files, frame_file_prefix)
+    try:
+        colormap_from_frames(frame_files, frame_file_prefix)
+    finally:
+        for file in frame_files:
+            os.remove(file)
+
+def frame_size(source):
+    output = subprocess.check_output(['ffprobe',
+                                      '-v', 'error',
+                                      '-select_streams', 'v:0',
+                                      '-show_entries', 'stream=width,height',
+                                      '-of', 'json',
+                                      str(source)])
+    stream = json.loads(output.decode())['streams'][0]
+    return int(stream['width']), int(stream['height'])
+
+def frames_from_stream(source):
+    # yield one rgb frame per second as a uint8 array of
+    # shape (height, width, 3) read from ffmpeg's stdout.
+    # rotation is not applied so that frames keep the
+    # dimensions reported by ffprobe, colors are unaffected
+    width, height = frame_size(source)
+    frame_bytes = width * height * 3
+    process = subprocess.Popen(['ffmpeg',
+                                '-noautorotate',
+                                '-i',
+                                str(source),
+                                '-vf',
+                                'fps=1',
+                                '-f',
+                                'rawvideo',
+                                '-pix_fmt',
+                                'rgb24',
+                                '-'],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            frame = process.stdout.read(frame_bytes)
+            if len(frame) < frame_bytes:
+                break
+            yield np.frombuffer(frame, dtype=np.uint8).reshape((height, width, 3))
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+        process.wait()
 
 def colormap_from_frames(sources, map_file_prefix=""):
     created_map_files = []
+    resolutions = []
     for resolution in COLORMAP_RESOLUTIONS:
         map_file = pathlib.PurePath(VIZAVIZ_DATA_DIR, '{0}_{1}.npy'.format(map_file_prefix, resolution))
         created_map_files.append(map_file)
         if not os.path.isfile(map_file):
-            print("creating colormap {0} for resolution: {1}".format(map_file_prefix, resolution))
-            sources.sort()
-            color_map = []
-            for file in sources:
-                color_map.append(create_map(file, resolution))
+            resolutions.append(resolution)
 
-            rgb_array = np.zeros(shape=(len(sources), resolution, 3))
-            for imgslice, pixel_group in enumerate(color_map):
-                for res, (_, rgb) in enumerate(pixel_group):
-                    for px, pixel in enumerate(rgb): 
-                        rgb_array[imgslice][res][px] = pixel
+    if resolutions:
+        print("creating colormap {0} for resolutions: {1}".format(map_file_prefix, resolutions))
+        # sources are either frame files or
+        # a stream of already decoded frames
+        if isinstance(sources, list):
+            sources.sort()
+        # decode each frame once and quantize it
+        # for every missing resolution
+        color_maps = {resolution : [] for resolution in resolutions}
+        frames = 0
+        if WORKERS > 1:
+            frame_maps = create_maps_parallel(sources, resolutions, WORKERS)
+        else:
+            frame_maps = (create_maps(frame, resolutions) for frame in sources)
+        for frame_map in frame_maps:
+            for resolution, colors in frame_map.items():
+                color_maps[resolution].append(colors)
+            frames += 1
 
+        for resolution in resolutions:
+            map_file = pathlib.PurePath(VIZAVIZ_DATA_DIR, '{0}_{1}.npy'.format(map_file_prefix, resolution))
+            rgb_array = np.array(color_maps[resolution], dtype=np.uint8).reshape((frames, resolution, 3))
             np.save(str(map_file), rgb_array)
             print("saving colormap to {}".format(map_file))
-            colormap_to_db(str(map_file), resolution, map_file_prefix)
     return created_map_files
 
-def colormap_to_db(map_file, resolution, map_file_prefix=""):
-    rgb_array = np.load(str(map_file))
-    # store in redis as a flat list of numbers
-    # space delimited ie 1 2 3
-    #with np.printoptions(threshold=np.inf):
-    str_rgb_array = str(rgb_array.flatten()).replace(".", "").replace("\n", "")[1:-1]
+def audio_maps_from_file(source, map_file_prefix="", frames=None):
+    # full length spectral and loudness maps, one row per second
+    # like the video colormap. frames trims or pads the maps
+    # with black to line up with the video colormap
+    resolutions = [resolution for resolution in COLORMAP_RESOLUTIONS
+                   if not all(os.path.isfile(audio_map_file(map_file_prefix, map_name, resolution)) for map_name in AUDIO_MAPS)]
+    if not resolutions:
+        return
+    print("creating audio maps {0} for resolutions: {1}".format(map_file_prefix, resolutions))
+    audio_maps = {(map_name, resolution) : [] for map_name in AUDIO_MAPS for resolution in resolutions}
+    for block_maps in processors_audio.audio_maps(source, resolutions):
+        for resolution, colors in block_maps.items():
+            for map_name, map_colors in zip(AUDIO_MAPS, colors):
+                audio_maps[(map_name, resolution)].append(map_colors)
+
+    for (map_name, resolution), rows in audio_maps.items():
+        if not rows:
+            print("no audio found in {}".format(source))
+            return
+        rgb_array = np.array(rows, dtype=np.uint8).reshape((-1, resolution, 3))
+        if frames is not None:
+            rgb_array = rgb_array[:frames]
+            if len(rgb_array) < frames:
+                padding = np.zeros((frames - len(rgb_array), resolution, 3), dtype=np.uint8)
+                rgb_array = np.concatenate((rgb_array, padding))
+        map_file = audio_map_file(map_file_prefix, map_name, resolution)
+        np.save(str(map_file), rgb_array)
+        print("saving audio map to {}".format(map_file))
+
+def colormap_frames(map_file_prefix):
+    # frames in the video colormap of a source, None if there is none
+    for resolution in COLORMAP_RESOLUTIONS:
+        map_file = colormap_file(map_file_prefix, resolution)
+        if os.path.isfile(map_file):
+            return len(open_colormap(map_file))
+    return None
+
+def colormap_file(filehash, resolution, map_name="rgb_map"):
+    if map_name == "rgb_map":
+        return pathlib.PurePath(VIZAVIZ_DATA_DIR, '{0}_{1}.npy'.format(filehash, resolution))
+    return audio_map_file(filehash, map_name, resolution)
+
+def open_colormap(map_file):
+    # read-only memory map of a colormap file, slicing it only
+    # reads the pages of the frames used. maps stay open while
+    # the file is unchanged
+    stat = os.stat(str(map_file))
+    return load_colormap(str(map_file), stat.st_mtime_ns, stat.st_size)
+
+@functools.lru_cache(maxsize=COLORMAP_OPEN_FILES)
+def load_colormap(map_file, mtime_ns, size):
+    return np.load(map_file, mmap_mode='r')
+
+def get_frames(filehash, resolution, start=None, stop=None, map_name="rgb_map"):
+    # frames start to stop of a colormap as a read-only uint8
+    # array of shape (frames, resolution, 3), raises OSError
+    # if the map has not been created
+    return open_colormap(colormap_file(filehash, resolution, map_name))[start:stop]
+
+def audio_map_file(map_file_prefix, map_name, resolution):
+    # <hash>_spectral_map_<resolution>.npy
+    return pathlib.PurePath(VIZAVIZ_DATA_DIR, '{0}_{1}_{2}.npy'.format(map_file_prefix, map_name, resolution))
+
+def colormap_encode(rgb_array, resolution):
+    # pack a colormap as a small header followed by
+    # uint8 rgb bytes, frame by frame
+    rgb_array = np.asarray(rgb_array).reshape((-1, resolution, 3)).astype(np.uint8)
+    frames, resolution, rgb_values = rgb_array.shape
+    header = COLORMAP_HEADER.pack(COLORMAP_MAGIC, frames, resolution, rgb_values)
+    return header + rgb_array.tobytes()
+
+def colormap_decode(data):
+    # returns a read-only uint8 array of shape (frames, resolution, 3)
+    magic, frames, resolution, rgb_values = COLORMAP_HEADER.unpack_from(data)
+    if magic != COLORMAP_MAGIC:
+        raise ValueError("not an encoded colormap")
+    array = np.frombuffer(data, dtype=np.uint8, count=frames * resolution * rgb_values, offset=COLORMAP_HEADER.size)
+    return array.reshape((frames, resolution, rgb_values))
+
+def colormap_manifest(frames, resolution, chunk_frames=None, digest=None):
+    # describes how a colormap is split into chunks, digest
+    # identifies its contents so clients can cache renders
+    if chunk_frames is None:
+        chunk_frames = COLORMAP_CHUNK_FRAMES
+    return json.dumps({"frames" : frames,
+                       "resolution" : resolution,
+                       "chunk_frames" : chunk_frames,
+                       "chunks" : -(-frames // chunk_frames),
+                       "digest" : digest})
+
+def colormap_chunk_key(filehash, map_name, resolution):
+    # hash of encoded chunks of a colormap
+    return "source:{0}:map:{1}:resolution:{2}".format(filehash, map_name, resolution)
+
+def colormap_chunk_field(index):
+    return "chunk:{}".format(index)
+
+def colormap_fields(map_file, resolution, map_name="rgb_map"):
+    # source:<hash> fields for a colormap file, the map itself
+    # is stored in chunks and described by a manifest. the
+    # duration of a source comes from its rgb_map
+    rgb_array = open_colormap(map_file)
+    digest = hashlib.sha1(np.ascontiguousarray(rgb_array).tobytes()).hexdigest()
+    fields = {"map:{0}:resolution:{1}".format(map_name, str(resolution)) : colormap_manifest(len(rgb_array), resolution, digest=digest)}
+    if map_name == "rgb_map":
+        fields["duration"] = len(rgb_array)
+    return fields
+
+def colormap_chunk_fields(map_file, resolution):
+    # encoded chunks of COLORMAP_CHUNK_FRAMES frames
+    rgb_array = open_colormap(map_file)
+    fields = {}
+    for index, start in enumerate(range(0, len(rgb_array), COLORMAP_CHUNK_FRAMES)):
+        fields[colormap_chunk_field(index)] = colormap_encode(rgb_array[start:start + COLORMAP_CHUNK_FRAMES], resolution)
+    return fields
+
+def colormap_chunks_to_db(map_file, resolution, map_file_prefix="", map_name="rgb_map", db=None):
+    if db is None:
+        db = redis_conn
+    chunk_key = colormap_chunk_key(map_file_prefix, map_name, resolution)
+    chunk_fields = colormap_chunk_fields(map_file, resolution)
+    # drop chunks of a previous, longer map
+    db.delete(chunk_key)
+    if chunk_fields:
+        db.hmset(chunk_key, chunk_fields)
+
+def colormap_to_db(map_file, resolution, map_file_prefix="", db=None):
     # redis_conn here is used from global scope
-    redis_conn.hmset("source:{}".format(map_file_prefix), {"map:rgb_map:resolution:{}".format(str(resolution)) : str_rgb_array})
-    
-    duration = len(rgb_array)
-    redis_conn.hmset("source:{}".format(map_file_prefix), {"duration" : duration})
-
-def create_map(source_image, num_colors):
-    with Image.open(source_image) as pim:
-        im = pim.convert('P', palette=Image.ADAPTIVE, colors=num_colors)
-    pim.close()
-    im = im.convert('RGB')
-    colorlist = []
-    for color in im.getcolors(64000):
-        colorlist.append(color)
+    if db is None:
+        db = redis_conn
+    colormap_chunks_to_db(map_file, resolution, map_file_prefix, db=db)
+    db.hmset("source:{}".format(map_file_prefix), colormap_fields(map_file, resolution))
+
+def create_maps_parallel(sources, resolutions, workers):
+    # fan frames out over a process pool in order, a new frame
+    # is submitted as the oldest one is consumed so that at most
+    # WORKER_FRAMES frames per worker are held in memory
+    create = functools.partial(create_maps, resolutions=resolutions)
+    sources = iter(sources)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque(executor.submit(create, source)
+                                    for source in itertools.islice(sources, workers * WORKER_FRAMES))
+        while pending:
+            result = pending.popleft().result()
+            for source in itertools.islice(sources, 1):
+                pending.append(executor.submit(create, source))
+            yield result
+
+def create_maps(source_image, resolutions):
+    # returns {resolution : uint8 array of shape (resolution, 3)}
+    # source_image is an image file or a decoded rgb frame
+    if isinstance(source_image, np.ndarray):
+        im = Image.fromarray(source_image, 'RGB')
+    else:
+        with Image.open(source_image) as pim:
+            im = pim.convert('RGB')
+    color_maps = {}
+    for resolution in resolutions:
+        color_maps[resolution] = create_map(im, resolution)
     im.close()
-    return colorlist
+    return color_maps
+
+def create_map(image, num_colors):
+    # adaptive palette of an already decoded image, padded
+    # with black if fewer than num_colors are found
+    with image.convert('P', palette=Image.ADAPTIVE, colors=num_colors) as pim:
+        im = pim.convert('RGB')
+    colors = np.zeros((num_colors, 3), dtype=np.uint8)
+    for px, (_, rgb) in enumerate(im.getcolors(64000)[:num_colors]):
+        colors[px] = rgb
+    im.close()
+    return colors
 
 def visualize_loop(start, end, duration, resolution, loop_color=None, bg_color=None, cell_width=10, cell_height=10, return_image=False, return_format="PNG"):
     width = int(duration * resolution * cell_width)
@@ -288,61 +589,57 @@ async def ingest(urls, destination_directory):
                 redis_conn.sadd(history_key, url)
         else:
             print("url not valid: {}".format(url))
+def map_to_pixels(array, cell_width=10, cell_height=10, columns=None, width_cells=None):
+    # lay out rgb cells in rows of columns (or a single row if
+    # columns is None) and scale each cell to cell_width x cell_height
+    # pixels, returns a uint8 array of shape (height, width, 3)
+    cells = np.asarray(array).reshape((-1, 3)).astype(np.uint8)
+    if columns:
+        rows = int(len(cells) / columns)
+        grid = cells[:rows * columns].reshape((rows, columns, 3))
+    else:
+        grid = cells.reshape((1, -1, 3))
+
+    if width_cells is not None:
+        if grid.shape[1] > width_cells:
+            grid = grid[:, :width_cells]
+        elif grid.shape[1] < width_cells:
+            padding = np.zeros((grid.shape[0], width_cells - grid.shape[1], 3), dtype=np.uint8)
+            grid = np.concatenate((grid, padding), axis=1)
+
+    return np.repeat(np.repeat(grid, cell_height, axis=0), cell_width, axis=1)
+
 #@functools.lru_cache(maxsize=32)
-def visualize_map(map_file=None, map_raw=None, cell_width=10, cell_height=10, rows=None, columns=None, resolution=None, return_image=False, return_format="PNG", reverse_image=False):
+def visualize_map(map_file=None, map_raw=None, cell_width=10, cell_height=10, rows=None, columns=None, resolution=None, return_image=False, return_format="PNG", reverse_image=False, start=None, stop=None):
+    # start and stop select a range of frames
     if map_file:
         map_file = pathlib.PurePosixPath(map_file)
         # try to get resolution from filename if none provided
         if resolution is None:
-            resolution = int(map_file.stem.partition("_")[-1])
-        array = np.load(str(map_file))
-        # array = array.flatten()
-    elif map_raw:
+            resolution = int(map_file.stem.rpartition("_")[-1])
+        array = open_colormap(map_file)[start:stop]
+    elif map_raw is not None:
         # must specify resolution in kwargs
         rgb_values = 3
-        array = np.array(map_raw)
-        # create rgb cells
-        array = array.reshape((-1, rgb_values))
-        # split frames
-        array = np.split(array, len(array) / resolution)
-        # reverse the array so that image flows bottom to
-        # top instead of top to bottom
-        # doing it this way to be easier for in-progress gui
+        array = np.asarray(map_raw)
+        # split into frames of rgb cells
+        array = array.reshape((-1, resolution, rgb_values))[start:stop]
 
     if reverse_image is True:
+        # reverse the array so that image flows bottom to
+        # top instead of top to bottom
         array = array[::-1]
 
-    cells = len([cell for cell in array]) * resolution
-
     if columns == "auto":
         columns = resolution
-        width = resolution * cell_width
-        height = cell_height * int(cells / columns)
-    elif columns:
-        width = resolution * cell_width
-        height = cell_height * int(cells / columns)
+
+    if columns:
+        # width is always a single frame wide
+        pixels = map_to_pixels(array, cell_width, cell_height, columns=columns, width_cells=resolution)
     else:
-        # some _32 with single row are not working?
-        height = cell_height
-        width = cells * cell_width
-
-    visualization_image = Image.new("RGB", (width, height))
-    x = 0
-    y = 0
-    columns_filled = 0
-    for frame in array:
-        for rgb_cell in frame:
-            fill_rgb = [int(c) for c in rgb_cell]
-            draw = ImageDraw.Draw(visualization_image)
-            draw.rectangle(((x, y),
-                            (x + cell_width, y + cell_height)),
-                            fill=(*fill_rgb, 0))
-            x += cell_width
-            if columns_filled == columns:
-                y += cell_height
-                x = 0
-                columns_filled = 0
-            columns_filled += 1
+        pixels = map_to_pixels(array, cell_width, cell_height)
+
+    visualization_image = Image.fromarray(pixels, "RGB")
 
     if return_image:
         image_bytes = io.BytesIO()
@@ -353,6 +650,69 @@ def visualize_map(map_file=None, map_raw=None, cell_width=10, cell_height=10, ro
     else:
         visualization_image.show()
 
+def file_fingerprint(file):
+    stat = os.stat(file)
+    return "{size}:{mtime}:{inode}".format(size=stat.st_size, mtime=stat.st_mtime_ns, inode=stat.st_ino)
+
+def hash_file(file):
+    # content hashes are cached by path and only recomputed
+    # when the size, mtime or inode of the file changes
+    #
+    # vizaviz:<server>:fingerprints path : "<size>:<mtime>:<inode> <hash>"
+    fingerprints_key = "vizaviz:{server_id}:fingerprints".format(server_id=SERVER_ID)
+    path = str(pathlib.Path(file).resolve())
+    fingerprint = file_fingerprint(file)
+    cached = redis_conn.hget(fingerprints_key, path)
+    if cached:
+        cached_fingerprint, _, cached_hash = cached.partition(" ")
+        if cached_fingerprint == fingerprint:
+            return cached_hash
+
+    file_hash = content_hash(file)
+    redis_conn.hset(fingerprints_key, path, "{0} {1}".format(fingerprint, file_hash))
+    return file_hash
+
+def hash_files(files):
+    # hash several files at once, hashlib releases
+    # the gil while digesting large chunks. files that
+    # cannot be read, such as downloads renamed or
+    # removed since they were found, are left out
+    with concurrent.futures.ThreadPoolExecutor(max_workers=HASH_THREADS) as executor:
+        futures = {file : executor.submit(hash_file, file) for file in files}
+    file_hashes = {}
+    for file, future in futures.items():
+        try:
+            file_hashes[file] = future.result()
+        except OSError as ex:
+            print("could not hash {0}: {1}".format(file, ex))
+    return file_hashes
+
+def content_hash(file, algorithm=None):
+    # read in bounded chunks instead of loading the entire file
+    #
+    # cached hashes in the fingerprints key are reused whatever
+    # the current algorithm, so sha1 hashes of unchanged files
+    # (and the artifacts named after them) stay valid
+    if algorithm is None:
+        algorithm = HASH_ALGORITHM
+    if algorithm == "sha1":
+        digest = hashlib.sha1()
+    else:
+        # same length as a sha1 hexdigest
+        digest = hashlib.blake2b(digest_size=20)
+
+    with open(file, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if algorithm == "sampled" and size > 3 * HASH_SAMPLE_SIZE:
+            digest.update(str(size).encode())
+            for offset in (0, (size - HASH_SAMPLE_SIZE) // 2, size - HASH_SAMPLE_SIZE):
+                f.seek(offset)
+                digest.update(f.read(HASH_SAMPLE_SIZE))
+        else:
+            for chunk in iter(functools.partial(f.read, HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
 def file_already_processed(file_hash):
     for resolution in COLORMAP_RESOLUTIONS:
         processed = pathlib.PurePath(VIZAVIZ_DATA_DIR, "{file_hash}_{resolution}.npy".format(file_hash=file_hash, resolution=resolution))
@@ -374,36 +734,18 @@ async def ingest_from(check_interval=30):
         print("source from: sleeping {}".format(count))
         await trio.sleep(1)
 
-async def source_from(directory_name, directory_check_interval, processed_sources):
+def is_source_file(path):
+    # youtube-dl writes name.f<format>.mp4 and name.temp.mp4
+    # while downloading, those are merged or renamed after
+    return str(path).endswith(".mp4") and not YOUTUBE_DL_PARTIAL.search(str(path))
+
+def source_files_in(directory_name):
     p = pathlib.Path(directory_name)
     # include jpg, bmp -- treat as duration 0 -1
-    source_files = list(p.glob('**/*.mp4'))
-    for file in source_files:
-        if file not in processed_sources:
-            with open(file,'rb') as f:
-                file_hash = hashlib.sha1(f.read()).hexdigest()
-            audio_image_from_file(file, file_hash)
-            images_to_db()
-            if not file_hash in processed_sources.values() and not file_already_processed(file_hash):
-                # if hash not found in dict, process
-                # process audio image
-                try:
-                    frames_from_file(file, VIZAVIZ_TEMP_DIR, frame_file_prefix=file_hash)
-                    processed_sources[file] = file_hash
-                    redis_conn.hmset("source:{}".format(file_hash), {"filename" : file})
-                    redis_conn.hmset("source:{}".format(file_hash), {"filehash" : file_hash})
-                except Exception as ex:
-                    print("exception while processing file: {0} {1}".format(file, ex))
-            else:
-                processed_sources[file] = file_hash
-                redis_conn.hmset("source:{}".format(file_hash), {"filename" : file})
-                redis_conn.hmset("source:{}".format(file_hash), {"filehash" : file_hash})
-                # files exist...
-                # check if maps are in db
-                for resolution in COLORMAP_RESOLUTIONS:
-                    map_file = pathlib.PurePath(VIZAVIZ_DATA_DIR, '{0}_{1}.npy'.format(file_hash, resolution))
-                    if os.path.isfile(map_file):
-                        colormap_to_db(map_file, resolution, file_hash)
+    return [file for file in p.glob('**/*.mp4') if is_source_file(file)]
+
+async def source_from(directory_name, directory_check_interval, processed_sources):
+    await process_sources(source_files_in(directory_name), processed_sources)
 
     # sleep for interval
     for count in range(directory_check_interval):
@@ -411,13 +753,128 @@ async def source_from(directory_name, directory_check_interval, processed_source
         await trio.sleep(1)
     await q.put(processed_sources)
 
+async def watch_sources(watcher, directories, processed_sources):
+    # process files that exist before watching, then only
+    # files written or moved into the watched directories
+    for directory in directories:
+        print("watching directory: {}".format(directory))
+        watcher.add_tree(directory)
+    for directory in directories:
+        await process_sources(source_files_in(directory), processed_sources)
+    record_sources(processed_sources)
+
+    while True:
+        events = await trio.run_sync_in_worker_thread(watcher.read, cancellable=True)
+        source_files = []
+        for path, mask in events:
+            if path is None:
+                # event queue overflowed, rescan everything
+                for directory in directories:
+                    source_files.extend(source_files_in(directory))
+            elif mask & (watchers.IN_CLOSE_WRITE | watchers.IN_MOVED_TO) and is_source_file(path):
+                file = pathlib.Path(path)
+                # reprocess files that have been rewritten
+                processed_sources.pop(file, None)
+                source_files.append(file)
+        if source_files:
+            await process_sources(list(dict.fromkeys(source_files)), processed_sources)
+            record_sources(processed_sources)
+
+def record_sources(processed_sources):
+    if processed_sources:
+        redis_conn.hmset("vizaviz:{server_id}:sources".format(server_id=SERVER_ID), processed_sources)
+
+async def process_sources(source_files, processed_sources):
+    # skip files removed since they were found
+    unprocessed_files = [file for file in source_files if file not in processed_sources and os.path.isfile(file)]
+    file_hashes = await trio.run_sync_in_worker_thread(hash_files, unprocessed_files)
+    for file in unprocessed_files:
+        if file in file_hashes and file not in processed_sources:
+            try:
+                # decoding and analysis run off the trio thread so
+                # that ipc and key events are handled meanwhile
+                await trio.run_sync_in_worker_thread(process_source,
+                                                     file,
+                                                     file_hashes[file],
+                                                     processed_sources,
+                                                     limiter=process_limiter)
+            except Exception as ex:
+                print("exception while processing file: {0} {1}".format(file, ex))
+
+def process_source(file, file_hash, processed_sources):
+    # writes for a source are sent as a single transaction
+    # with one hmset to source:<hash> so that clients see
+    # one update instead of a field by field stream
+    pipe = redis_conn.pipeline(transaction=True)
+    source_fields = {}
+    audio_image_from_file(file, file_hash)
+    images_to_db(map_file_prefix=file_hash, db=pipe)
+    if not file_hash in processed_sources.values() and not file_already_processed(file_hash):
+        # if hash not found in dict, process
+        # process audio image
+        try:
+            frames_from_file(file, VIZAVIZ_TEMP_DIR, frame_file_prefix=file_hash)
+            processed_sources[file] = file_hash
+            source_fields.update({"filename" : file, "filehash" : file_hash})
+        except Exception as ex:
+            print("exception while processing file: {0} {1}".format(file, ex))
+    else:
+        processed_sources[file] = file_hash
+        source_fields.update({"filename" : file, "filehash" : file_hash})
+        # files exist...
+
+    if source_fields:
+        try:
+            audio_maps_from_file(file, file_hash, frames=colormap_frames(file_hash))
+        except Exception as ex:
+            print("exception while creating audio maps: {0} {1}".format(file, ex))
+        # check if maps are in db
+        for resolution in COLORMAP_RESOLUTIONS:
+            for map_name in ["rgb_map"] + AUDIO_MAPS:
+                map_file = colormap_file(file_hash, resolution, map_name)
+                if os.path.isfile(map_file):
+                    colormap_chunks_to_db(map_file, resolution, file_hash, map_name, db=pipe)
+                    source_fields.update(colormap_fields(map_file, resolution, map_name))
+        pipe.hmset("source:{}".format(file_hash), source_fields)
+    pipe.execute()
+
+def read_key_events(pubsub, timeout):
+    # block until a message arrives or timeout passes,
+    # then drain anything else already received
+    messages = []
+    message = pubsub.get_message(timeout=timeout)
+    while message:
+        messages.append(message)
+        message = pubsub.get_message()
+    return messages
+
 async def handle_key_events(redis_conn, q):
     pubsub = redis_conn.pubsub()
     pubsub.psubscribe("__keyspace@0__:*")
     #pubsub.psubscribe(**{'__keyspace@0__:*': event_handler})
-    while True:  
-        message = pubsub.get_message()
-        if message:
+    try:
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(dispatch_key_events, redis_conn, pubsub)
+            # for now, any message in q ends function
+            await q.get()
+            nursery.cancel_scope.cancel()
+    finally:
+        pubsub.close()
+
+async def dispatch_key_events(redis_conn, pubsub):
+    while True:
+        if last_state_sweep is None:
+            timeout = 0
+        else:
+            timeout = max(0, STATE_SWEEP_INTERVAL - (time.monotonic() - last_state_sweep))
+        # blocking read in a worker thread, the thread is abandoned
+        # if cancelled and exits once its timeout passes so the
+        # read is capped to keep abandoned threads short lived
+        timeout = min(timeout, KEY_EVENT_READ_TIMEOUT)
+        messages = await trio.run_sync_in_worker_thread(read_key_events, pubsub, timeout, cancellable=True)
+        # loop keys changed in this batch, reconciled once each
+        loop_keys = []
+        for message in messages:
             # print(message)
             if message["data"] == "sadd" and "ingest" in message["channel"]:
                 # how to handle ingest?
@@ -438,37 +895,64 @@ async def handle_key_events(redis_conn, q):
                 # can't get pid because key already deleted by client
                 #loop_pid = int(redis_conn.hget(loop_key, 'pid'))
                 despawn_loop(loop_pid)
+                mpv_pool.close(loop_id)
+                loop_locks.pop(loop_id, None)
+            elif message["channel"].startswith("__keyspace@0__:vizaviz:{server_id}:loop:".format(server_id=SERVER_ID)):
+                loop_key = message["channel"].replace("__keyspace@0__:","")
+                if loop_key not in loop_keys:
+                    loop_keys.append(loop_key)
+
+        for loop_key in loop_keys:
+            await reconcile_loop(redis_conn, loop_key)
+
+        if last_state_sweep is None or time.monotonic() - last_state_sweep >= STATE_SWEEP_INTERVAL:
+            # safety net for missed events / exited processes
             await get_state(redis_conn)
-        else:
-            try:
-                # for now, any message in q ends function
-                q.get_nowait()
-                break
-            except Exception as ex:
-                await trio.sleep(0.01)
 
 async def main(directories, redis_conn):
-    directory_check_interval = 10
-    # path/filename : contents hash
-    processed_sources = {}
-    key_q = trio.Queue(1)
+    global mpv_pool, spawn_limiter, process_limiter
+    spawn_limiter = trio.CapacityLimiter(SPAWN_LIMIT)
+    process_limiter = trio.CapacityLimiter(1)
     try:
-        while True:
-            async with trio.open_nursery() as nursery:
-                nursery.start_soon(handle_key_events, redis_conn, key_q)
-                for directory in directories:
-                    print("checking directory: {}".format(directory))
-                    nursery.start_soon(source_from, directory, directory_check_interval, processed_sources)
-                    nursery.start_soon(ingest_from)
-                sources_from_directory = await q.get()
-                processed_sources.update(sources_from_directory)
-                if processed_sources:
-                    redis_conn.hmset("vizaviz:{server_id}:sources".format(server_id=SERVER_ID), processed_sources)
-                key_q.put_nowait("stop")
+        async with trio.open_nursery() as ipc_nursery:
+            # connection readers run for the lifetime of the server
+            mpv_pool = mpv_ipc.MpvPool(VIZAVIZ_FIFO_DIR, ipc_nursery, on_property_change=loop_property_changed)
+            await serve(directories, redis_conn)
+            ipc_nursery.cancel_scope.cancel()
     except Exception as ex:
         # trio works with ctrl-c
         print(ex, "exiting...")
 
+async def serve(directories, redis_conn):
+    directory_check_interval = 10
+    # path/filename : contents hash
+    processed_sources = {}
+    key_q = trio.Queue(1)
+    watcher = None
+    if WATCH_MODE == "inotify":
+        try:
+            watcher = watchers.Inotify()
+        except OSError as ex:
+            print("inotify unavailable, polling directories: {}".format(ex))
+    if watcher is not None:
+        async with trio.open_nursery() as nursery:
+            # key_q is never used to stop key events
+            # since there is no polling cycle
+            nursery.start_soon(handle_key_events, redis_conn, key_q)
+            nursery.start_soon(watch_sources, watcher, directories, processed_sources)
+            nursery.start_soon(ingest_from)
+    while True:
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(handle_key_events, redis_conn, key_q)
+            for directory in directories:
+                print("checking directory: {}".format(directory))
+                nursery.start_soon(source_from, directory, directory_check_interval, processed_sources)
+                nursery.start_soon(ingest_from)
+            sources_from_directory = await q.get()
+            processed_sources.update(sources_from_directory)
+            record_sources(processed_sources)
+            key_q.put_nowait("stop")
+
 def create_xdg_dirs():
     for directory in (VIZAVIZ_DATA_DIR, VIZAVIZ_TEMP_DIR, VIZAVIZ_FIFO_DIR, VIZAVIZ_CONFIG_DIR):
         if not os.path.isdir(directory):
@@ -489,7 +973,11 @@ if __name__ == "__main__":
                         help="resolutions to use")
 
     parser.add_argument("--server-name", default=None)
-    parser.add_argument("--show-map", default=None)
+    parser.add_argument("--show-map",
+                        default=None,
+                        help="colormap file, or a source hash with --show-resolution")
+    parser.add_argument("--show-start", default=None, type=int, help="first frame to show")
+    parser.add_argument("--show-stop", default=None, type=int, help="frame to stop showing at")
     parser.add_argument("--show-resolution", default=None, type=int)
     parser.add_argument("--show-columns", default=None, type=int)
     parser.add_argument("--show-cell-width", default=10, type=int)
@@ -501,9 +989,35 @@ if __name__ == "__main__":
     parser.add_argument("--temp-dir", default=VIZAVIZ_TEMP_DIR)
     parser.add_argument("--fifo-dir", default=VIZAVIZ_FIFO_DIR)
     parser.add_argument("--config-dir", default=VIZAVIZ_CONFIG_DIR)
+    parser.add_argument("--workers",
+                        default=WORKERS,
+                        type=int,
+                        help="processes to use for colormap extraction")
+    parser.add_argument("--hash-algorithm",
+                        default=HASH_ALGORITHM,
+                        choices=HASH_ALGORITHMS,
+                        help="hash for new or changed files, sha1 matches existing artifacts")
+    parser.add_argument("--hash-threads",
+                        default=HASH_THREADS,
+                        type=int,
+                        help="files to hash in parallel")
+    parser.add_argument("--watch",
+                        default=WATCH_MODE,
+                        choices=WATCH_MODES,
+                        help="how to find new sources, inotify falls back to poll if unavailable")
+    parser.add_argument("--spawn-limit",
+                        default=SPAWN_LIMIT,
+                        type=int,
+                        help="loops to start at the same time")
+    parser.add_argument("--frames-to-disk",
+                        action="store_true",
+                        help="extract frames to temp-dir as bmp files instead of streaming them from ffmpeg")
 
     args = parser.parse_args()
 
+    if args.show_map and args.show_resolution is None and not os.path.isfile(args.show_map):
+        parser.error("--show-map with a source hash requires --show-resolution")
+
     VIZAVIZ_SERVER_DIRS = args.source_dir
 
     if args.data_dir != VIZAVIZ_DATA_DIR:
@@ -518,6 +1032,13 @@ if __name__ == "__main__":
     if args.fifo_dir != VIZAVIZ_FIFO_DIR:
         VIZAVIZ_FIFO_DIR = args.fifo_dir
 
+    FRAMES_TO_DISK = args.frames_to_disk
+    WORKERS = max(1, args.workers)
+    HASH_ALGORITHM = args.hash_algorithm
+    HASH_THREADS = max(1, args.hash_threads)
+    WATCH_MODE = args.watch
+    SPAWN_LIMIT = max(1, args.spawn_limit)
+
     create_xdg_dirs()
 
     try:
@@ -534,10 +1055,20 @@ if __name__ == "__main__":
         COLORMAP_RESOLUTIONS = args.map_resolutions
 
     if args.show_map:
-        visualize_map(args.show_map,
-                      resolution=args.show_resolution,
-                      cell_height=args.show_cell_height,
-                      cell_width=args.show_cell_width,
-                      columns=args.show_columns)
+        if os.path.isfile(args.show_map):
+            visualize_map(args.show_map,
+                          resolution=args.show_resolution,
+                          cell_height=args.show_cell_height,
+                          cell_width=args.show_cell_width,
+                          columns=args.show_columns,
+                          start=args.show_start,
+                          stop=args.show_stop)
+        else:
+            # show_map is a source hash
+            visualize_map(map_raw=get_frames(args.show_map, args.show_resolution, args.show_start, args.show_stop),
+                          resolution=args.show_resolution,
+                          cell_height=args.show_cell_height,
+                          cell_width=args.show_cell_width,
+                          columns=args.show_columns)
     else:
         trio.run(main, args.source_dir, redis_conn)
\ No newline at end of file
@@ -7,9 +7,15 @@
 import redis
 import argparse
 import io
+import os
+import json
+import collections
+import hashlib
+import threading
 import math
 import uuid
-from vizaviz import visualize_map, visualize_loop
+import numpy as np
+from vizaviz import visualize_map, visualize_loop, colormap_decode, colormap_chunk_key, colormap_chunk_field, COLORMAP_MAGIC, VIZAVIZ_CACHE_DIR
 import bindings
 from kivy.config import Config
 Config.set('graphics', 'width',  1600)
@@ -19,7 +25,8 @@ from kivy.lang import Builder
 from kivy.core.window import Window
 from kivy.uix.tabbedpanel import TabbedPanel, TabbedPanelItem
 from kivy.graphics.vertex_instructions import Rectangle
-from kivy.graphics import Color, Line, Ellipse, InstructionGroup
+from kivy.graphics import Color, Line, Ellipse, Point, InstructionGroup
+from kivy.graphics.texture import Texture
 from kivy.core.text import Label as CoreLabel
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.stencilview import StencilView
@@ -41,6 +48,16 @@ from kivy.uix.scatter import Scatter
 import pathlib
 #vzz-gui
 Config.read('config.ini')
+# sources fetched per pipelined round trip
+SOURCE_BATCH_SIZE = 500
+# bump to invalidate cached renders when map rendering changes
+RENDER_CACHE_VERSION = 2
+# seconds to collect keyspace events before refreshing
+DB_EVENT_WINDOW = 0.1
+# colormap chunks kept in memory and chunks fetched
+# on each side of those needed for the viewport
+CHUNK_CACHE_SIZE = 256
+CHUNK_PREFETCH = 1
 kv = """
 #:import ScrollEffect  kivy.effects.scroll.ScrollEffect
 <ScatterTextWidget>:
@@ -375,72 +392,84 @@ class LoopItem(BoxLayout):
         self.draw_viewport()
 
     def draw_viewport(self):
-        with self.app.detailed.canvas:
-
-            self.app.detailed.canvas.remove_group("viewport")
-            self.app.detailed.canvas.remove_group("selection")
-            cell_width = int(self.settings["cell_width"])
-            cell_height = int(self.settings["cell_height"])
-            resolution = int(self.settings["resolution"])
-            increment = int(self.settings["increment"])
-            viewport_cols = int(self.settings["resolution"] * self.settings["columns"])
-            viewport_rows = int(self.settings['viewgrid_rows'])
-            # calculate viewport
-            # this is all being drawn / redrawn on canvas
-            # could also use a scrollview
-            # currently incorrect
-            viewport_start = self.settings['viewgrid_start_segment']
-            viewport_end = self.settings['viewgrid_start_segment'] + (self.settings['viewgrid_rows'] * self.settings["columns"])
-            
-            # y offset to start above lower containers
-            y_offset = 100
-
+        canvas = self.app.detailed.canvas
+        canvas.remove_group("viewport")
+        canvas.remove_group("selection")
+        canvas.remove_group("viewgrid")
+        cell_width = int(self.settings["cell_width"])
+        cell_height = int(self.settings["cell_height"])
+        resolution = int(self.settings["resolution"])
+        increment = int(self.settings["increment"])
+        viewport_cols = int(self.settings["resolution"] * self.settings["columns"])
+        viewport_rows = int(self.settings['viewgrid_rows'])
+        grid_columns = int(self.settings['viewgrid_columns'])
+        # calculate viewport
+        # this is all being drawn / redrawn on canvas
+        # could also use a scrollview
+        # currently incorrect
+        viewport_start = int(self.settings['viewgrid_start_segment'])
+        viewport_end = viewport_start + int(self.settings['viewgrid_rows'] * self.settings["columns"])
+
+        # y offset to start above lower containers
+        y_offset = 100
+
+        with canvas:
             # draw point grid
-            self.app.detailed.canvas.remove_group("viewgrid")
-            for y in range(0, int(self.settings['viewgrid_rows'] * cell_height), cell_height):
-                for x in range(0, int(self.settings['viewgrid_columns'] * cell_width), cell_width):
-                    Color(1, 1, 1, self.settings['viewgrid_opacity'])
-                    Ellipse(size=(2, 2), pos=(x, y + y_offset), group="viewgrid")
-
-            z = self.app.sources[self.loop["filehash"]]["maps"]["rgb_map"]["resolutions"][resolution]["raw"]#.split(" ")
-            z = list(filter(None, z.split(" ")))
-            z = [int(s) for s in z]
-            # loop
-            start = float(self.loop['start'])
-            end = float(self.loop['end'])
-            duration = end - start
-            duration *= resolution
-            # 3 for r,g,b
-            cell_length = 3
-            cell = viewport_start
-
-            z = z[viewport_start * self.settings['viewgrid_columns'] * cell_length : viewport_end * self.settings['viewgrid_columns'] * cell_length]
-            for y in range(0, int(viewport_rows * cell_height), cell_height):
-                for x in range(0, viewport_cols * cell_width, cell_width):
-                    try:
-                        r,g,b = [z.pop(0) for idx in range(3)]
-                        current_frame = math.ceil(cell / resolution)
-                        # print(current_frame, start, end, cell)
-                        r /= 255
-                        g /= 255
-                        b /= 255
-                        w = cell_width
-                        h = cell_height
-                        a = 1
-                        Color(r,g,b,a)
-                        Rectangle(size=(w, h), pos=(x, y + y_offset), group="viewport")
-                        if current_frame >= start and current_frame <= end:
-                            # Color(1,1,1,1)
-                            Rectangle(size=(w, h), pos=(x + (cell_width * viewport_cols) + 20, y + y_offset), group="selection")
-                        cell += 1
-                    except Exception as ex:
-                        # print(ex)
-                        pass
+            points = []
+            for y in range(0, viewport_rows * cell_height, cell_height):
+                for x in range(0, grid_columns * cell_width, cell_width):
+                    points.extend((x + 1, y + y_offset + 1))
+            Color(1, 1, 1, self.settings['viewgrid_opacity'], group="viewgrid")
+            Point(points=points, pointsize=1, group="viewgrid")
+
+        if viewport_rows < 1 or viewport_cols < 1:
+            return
+
+        # rgb cells in the viewport, drawn left to right
+        # from the bottom row up
+        first_cell = max(0, viewport_start * grid_columns)
+        last_cell = min(max(0, viewport_end * grid_columns), first_cell + viewport_rows * viewport_cols)
+        # only the frames of visible cells are fetched
+        first_frame = first_cell // resolution
+        frames = self.app.get_frames(self.loop["filehash"], resolution, first_frame, -(-last_cell // resolution))
+        cells = frames.reshape((-1, 3))[first_cell - first_frame * resolution:last_cell - first_frame * resolution]
+        viewport = np.zeros((viewport_rows * viewport_cols, 4), dtype=np.uint8)
+        viewport[:len(cells), :3] = cells
+        viewport[:len(cells), 3] = 255
+
+        # loop
+        start = float(self.loop['start'])
+        end = float(self.loop['end'])
+        # frame of each cell, cells within the loop are
+        # repeated to the right of the viewport
+        current_frames = np.ceil((viewport_start + np.arange(len(cells))) / resolution)
+        selection = viewport.copy()
+        selection[:len(cells), 3] *= (current_frames >= start) & (current_frames <= end)
+
+        size = (viewport_cols * cell_width, viewport_rows * cell_height)
+        with canvas:
+            Color(1, 1, 1, 1, group="viewport")
+            Rectangle(texture=self.viewport_texture(viewport, viewport_cols, viewport_rows),
+                      size=size,
+                      pos=(0, y_offset),
+                      group="viewport")
+            Rectangle(texture=self.viewport_texture(selection, viewport_cols, viewport_rows),
+                      size=size,
+                      pos=((cell_width * viewport_cols) + 20, y_offset),
+                      group="selection")
+
+    def viewport_texture(self, rgba_cells, cols, rows):
+        # one texel per cell, scaled up without smoothing
+        texture = Texture.create(size=(cols, rows), colorfmt="rgba")
+        texture.mag_filter = "nearest"
+        texture.min_filter = "nearest"
+        texture.blit_buffer(rgba_cells.tobytes(), colorfmt="rgba", bufferfmt="ubyte")
+        return texture
 
     def remove_loop(self, widget):
         loop_key = "vizaviz:{server}:loop:{loop_id}".format(server="foo", loop_id=self.loop['uuid'])
         redis_conn.delete(loop_key)
-        self.parent.app.update_loops()
+        self.app.update_loops([loop_key])
 
     def adjust_setting(self, attribute, value, value_display_widget=None):
         try:
@@ -726,6 +755,143 @@ class ScrollViewer(ScrollView):
     def on_touch_up(self, touch):
         return super().on_touch_up(touch)
 
+class RenderCache(object):
+    """Size bounded on-disk cache of rendered map images
+
+    entries are named by the key they were rendered from and
+    evicted least recently used first once max_bytes is exceeded
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = pathlib.Path(directory)
+        self.max_bytes = max_bytes
+        os.makedirs(str(self.directory), exist_ok=True)
+        self.total_bytes = sum(entry.stat().st_size for entry in self.directory.glob("*.render"))
+
+    def path(self, key):
+        return self.directory / "{}.render".format("_".join(str(part) for part in key))
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(str(path), "rb") as f:
+                image_bytes = io.BytesIO(f.read())
+            # mark as recently used
+            os.utime(str(path))
+            return image_bytes
+        except OSError:
+            return None
+
+    def put(self, key, image_bytes):
+        path = self.path(key)
+        data = image_bytes.getvalue()
+        temp_path = path.with_suffix(".tmp")
+        with open(str(temp_path), "wb") as f:
+            f.write(data)
+        os.replace(str(temp_path), str(path))
+        self.total_bytes += len(data)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def render(self, key, render_function):
+        image_bytes = self.get(key)
+        if image_bytes is None:
+            image_bytes = render_function()
+            self.put(key, image_bytes)
+            image_bytes.seek(0)
+        return image_bytes
+
+    def evict(self):
+        entries = []
+        for entry in self.directory.glob("*.render"):
+            try:
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry))
+            except OSError:
+                pass
+        self.total_bytes = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if self.total_bytes <= self.max_bytes:
+                break
+            try:
+                entry.unlink()
+                self.total_bytes -= size
+            except OSError:
+                pass
+
+class ChunkCache(object):
+    """Colormap chunks fetched from redis by chunk key and index
+
+    chunks are immutable for a filehash so they are only
+    dropped, least recently used first, past max_chunks
+    """
+    def __init__(self, max_chunks, prefetch=0):
+        self.max_chunks = max_chunks
+        self.prefetch = prefetch
+        # (chunk key, index) : array
+        self.chunks = collections.OrderedDict()
+
+    def get(self, chunk_key, first, last, manifest):
+        # returns chunks first to last inclusive, missing ones and
+        # up to prefetch neighbours are fetched in one round trip.
+        # chunks not found in redis are returned as black frames
+        # and fetched again on the next call
+        wanted = range(max(0, first - self.prefetch), min(manifest["chunks"], last + 1 + self.prefetch))
+        missing = [index for index in wanted if (chunk_key, index) not in self.chunks]
+        if missing:
+            fetched = binary_redis_conn.hmget(chunk_key, [colormap_chunk_field(index) for index in missing])
+            for index, data in zip(missing, fetched):
+                if data is not None:
+                    self.chunks[(chunk_key, index)] = colormap_decode(data)
+        found = []
+        for index in range(first, last + 1):
+            if (chunk_key, index) in self.chunks:
+                found.append(self.chunks[(chunk_key, index)])
+                self.chunks.move_to_end((chunk_key, index))
+            else:
+                print("missing chunk {0} of {1}".format(index, chunk_key))
+                frames = min(manifest["chunk_frames"], manifest["frames"] - index * manifest["chunk_frames"])
+                found.append(np.zeros((max(0, frames), manifest["resolution"], 3), dtype=np.uint8))
+        while len(self.chunks) > self.max_chunks:
+            self.chunks.popitem(last=False)
+        return found
+
+def decode_source(source):
+    # fields of a source:<hash> hash read from a binary connection,
+    # images are kept as bytes and colormap manifests as dicts,
+    # colormaps stored whole are decoded to arrays
+    decoded = {}
+    for k, v in source.items():
+        k = k.decode()
+        if k.startswith("map:") and ":image:" in k:
+            decoded[k] = io.BytesIO(v)
+        elif k.startswith("map:") and ":resolution:" in k:
+            try:
+                if v.startswith(COLORMAP_MAGIC):
+                    decoded[k] = colormap_decode(v)
+                else:
+                    manifest = json.loads(v.decode())
+                    if not isinstance(manifest, dict):
+                        raise ValueError("not a colormap manifest")
+                    decoded[k] = manifest
+            except ValueError as ex:
+                # maps in an older format are skipped
+                # until the server rewrites them
+                print("skipping {0}: {1}".format(k, ex))
+        else:
+            decoded[k] = v.decode()
+    return decoded
+
+def is_source_key(key):
+    # source:<hash>, not the chunk keys of its maps
+    if isinstance(key, bytes):
+        key = key.decode()
+    return key.startswith("source:") and key.count(":") == 1
+
+def image_digest(image):
+    if image is None:
+        return None
+    return hashlib.sha1(image.getvalue()).digest()
+
 def get_resolution(x):
     x = str(x)
     x = x.partition("_")[-1].partition(".")[0]
@@ -741,6 +907,17 @@ class VzzGuiApp(App):
         self._keyboard = Window.request_keyboard(self._keyboard_closed, self)
         self._keyboard.bind(on_key_down=self._on_keyboard_down)
         self.sources = {}
+        # (filehash, resolution, render) : ClickableSourceImage
+        self.source_images = {}
+        # filehash : [ClickableSourceImage]
+        self.filehash_images = {}
+        # loop key : loop
+        self.loops = {}
+        # keys changed since the last refresh, filled from
+        # the pubsub thread and handled on the kivy clock
+        self.db_changed_keys = set()
+        self.db_events_lock = threading.Lock()
+        self.db_events_trigger = Clock.create_trigger(self.refresh_changed, DB_EVENT_WINDOW)
         # use to allow switching between maps and their contents
         self.map_index = {}
         self.active_map = None
@@ -761,149 +938,292 @@ class VzzGuiApp(App):
         else:
             self.focus_name = ""
 
+        if "render_cache_mb" in kwargs:
+            render_cache_bytes = kwargs["render_cache_mb"] * 1024 * 1024
+        else:
+            render_cache_bytes = 512 * 1024 * 1024
+        self.render_cache = RenderCache(pathlib.PurePath(VIZAVIZ_CACHE_DIR, "renders"), render_cache_bytes)
+        self.chunk_cache = ChunkCache(CHUNK_CACHE_SIZE, CHUNK_PREFETCH)
+
         super(VzzGuiApp, self).__init__()
 
-    def update_loops(self):
+    def update_loops(self, loop_keys=None):
+        # update all loops or only the given loop keys, loops are
+        # indexed by key in self.loops and overlays are only drawn
+        # on the images of each loop's source
         print("updating loops....")
-        # self.loop_container.clear_loops()
-        updated_loops = set()
-        for key in redis_conn.scan_iter("vizaviz:{server}:loop:*".format(server="*")):
-            loop = redis_conn.hgetall(key)
-            updated_loops.add(loop['uuid'])
+        full_update = loop_keys is None
+        if full_update:
+            loop_keys = list(redis_conn.scan_iter("vizaviz:{server}:loop:*".format(server="*")))
+        else:
+            loop_keys = list(loop_keys)
+
+        pipe = redis_conn.pipeline(transaction=False)
+        for key in loop_keys:
+            pipe.hgetall(key)
+        for key, loop in zip(loop_keys, pipe.execute()):
+            if not loop:
+                self.remove_indexed_loop(key)
+                continue
+            self.loops[key] = loop
             # check if loop already added
             try:
-                if not self.loop_container.has_loop_by_id(loop['uuid']):
+                if loop['uuid'] not in self.loop_container.loop_ids:
                     self.loop_container.add_loop(loop)
                 else:
-                    try:
-                        self.loop_container.update_loop(loop['uuid'], loop)
-                    except KeyError:
-                        pass
+                    self.loop_container.update_loop(loop['uuid'], loop)
             except KeyError:
                 pass
 
             # draw loop regions on maps
-            for widget in self.group_container.image_grid.children:
-                if isinstance(widget, ClickableSourceImage):
-                    if widget.filehash == loop['filehash']:
-                        start = int(loop['start'])
-                        end = int(loop['end'])
-                        widget.draw_overlay(loop['filehash'], start, end, loop['uuid'])
-
-        # prune old loops
-        old_loops = set(self.loop_container.loop_ids) - set(updated_loops)
-        for loop_uuid in old_loops:
-            print("removing loop id {}".format(loop_uuid))
-            self.loop_container.remove_loop_by_id(loop_uuid)
-            for widget in self.group_container.image_grid.children:
-                try:
-                    widget.remove_overlay(loop_uuid)
-                except:
-                    pass
+            try:
+                for widget in self.filehash_images.get(loop['filehash'], []):
+                    self.draw_loop_overlay(widget, loop)
+            except KeyError:
+                pass
+
+        if full_update:
+            # prune old loops
+            for key in set(self.loops) - set(loop_keys):
+                self.remove_indexed_loop(key)
+            indexed_ids = set(loop.get('uuid') for loop in self.loops.values())
+            for loop_uuid in set(self.loop_container.loop_ids) - indexed_ids:
+                print("removing loop id {}".format(loop_uuid))
+                self.loop_container.remove_loop_by_id(loop_uuid)
+
+    def remove_indexed_loop(self, loop_key):
+        loop = self.loops.pop(loop_key, {})
+        loop_uuid = loop.get('uuid', loop_key.split(":")[-1])
+        print("removing loop id {}".format(loop_uuid))
+        self.loop_container.remove_loop_by_id(loop_uuid)
+        if 'filehash' in loop:
+            widgets = self.filehash_images.get(loop['filehash'], [])
+        else:
+            widgets = self.source_images.values()
+        for widget in widgets:
+            widget.remove_overlay(loop_uuid)
+
+    def draw_loop_overlay(self, widget, loop):
+        try:
+            start = int(loop['start'])
+            end = int(loop['end'])
+            widget.draw_overlay(loop['filehash'], start, end, loop['uuid'])
+        except (KeyError, ValueError) as ex:
+            print(ex)
 
-    def update_sources(self):
+    def update_sources(self, source_keys=None):
+        # load all sources or only the given source:<hash> keys
         print("updating sources...")
-        for key in redis_conn.scan_iter("source:*"):
-            source = {}
-            source_keys = redis_conn.hkeys(key)
-            # go key by key instead of hgetall
-            # to correctly load binary keys...
-            # source = redis_conn.hgetall(key)
-            for k in source_keys:
-                if "image:" in k:
-                    image_bytes = io.BytesIO()
-                    image_bytes.write(binary_redis_conn.hget(key, k))
-                    image_bytes.seek(0)
-                    source.update({k : image_bytes})
+        if source_keys is None:
+            source_keys = [key for key in binary_redis_conn.scan_iter("source:*", count=SOURCE_BATCH_SIZE) if is_source_key(key)]
+        else:
+            source_keys = [key for key in source_keys if is_source_key(key)]
+        # hgetall on the binary connection, pipelined in
+        # batches, so each batch of sources is one round trip
+        for batch_start in range(0, len(source_keys), SOURCE_BATCH_SIZE):
+            batch_keys = source_keys[batch_start:batch_start + SOURCE_BATCH_SIZE]
+            pipe = binary_redis_conn.pipeline(transaction=False)
+            for key in batch_keys:
+                pipe.hgetall(key)
+            for key, source in zip(batch_keys, pipe.execute()):
+                if source:
+                    self.load_source(decode_source(source))
                 else:
-                    source.update({ k : redis_conn.hget(key, k)})
-            try:
-                s = self.sources[source["filehash"]] = {}
-                s["filename"] = source["filename"]
-                s["filehash"] = source["filehash"]
-                s["duration"] = source["duration"]
-                #s["resolutions"] = {}
-                s["maps"] = {}
-                for k, v in source.items():
-                    if "map:" in k:
-                        # as int to allow sorting
-                        if "image:" in k:
-                            # bunch of bytes
-                            #map:foo:image:image_name
-                            _, map_name, _, image_name = k.split(":")
-                            if not map_name in s["maps"]:
-                                s["maps"][map_name] = {}
-                                s["maps"][map_name]["images"] = {}
-                                s["maps"][map_name]["images"][image_name] = v
-                                self.map_index[(map_name, image_name)] = (map_name, image_name)
-                        elif "resolution:" in k:
-                            _, map_name, _, resolution = k.split(":")
-                            resolution = int(resolution)
-                            #resolution = int(k.partition(":")[-1])
-                            raw_map = list(filter(None, v.split(" ")))
-                            if not map_name in s["maps"]:
-                                s["maps"][map_name] = {}
-                                s["maps"][map_name]["resolutions"] = {}
-                            s["maps"][map_name]["resolutions"][resolution] = {}
+                    # source key deleted
+                    if isinstance(key, bytes):
+                        key = key.decode()
+                    self.sources.pop(key.partition(":")[-1], None)
+
+    def load_source(self, source):
+        try:
+            s = self.sources[source["filehash"]] = {}
+            s["filename"] = source["filename"]
+            s["filehash"] = source["filehash"]
+            s["duration"] = source["duration"]
+            #s["resolutions"] = {}
+            s["maps"] = {}
+            for k, v in source.items():
+                if k.startswith("map:"):
+                    # as int to allow sorting
+                    if "image:" in k:
+                        # bunch of bytes
+                        #map:foo:image:image_name
+                        _, map_name, _, image_name = k.split(":")
+                        if not map_name in s["maps"]:
+                            s["maps"][map_name] = {}
+                            s["maps"][map_name]["images"] = {}
+                            s["maps"][map_name]["images"][image_name] = v
+                            self.map_index[(map_name, image_name)] = (map_name, image_name)
+                    elif "resolution:" in k:
+                        _, map_name, _, resolution = k.split(":")
+                        resolution = int(resolution)
+                        #resolution = int(k.partition(":")[-1])
+                        if not map_name in s["maps"]:
+                            s["maps"][map_name] = {}
+                            s["maps"][map_name]["resolutions"] = {}
+                        s["maps"][map_name]["resolutions"][resolution] = {}
+                        if isinstance(v, dict):
+                            # chunks are only fetched to render or view
+                            s["maps"][map_name]["resolutions"][resolution]["manifest"] = v
+                            s["maps"][map_name]["resolutions"][resolution]["chunk_key"] = colormap_chunk_key(s["filehash"], map_name, resolution)
+                        else:
                             s["maps"][map_name]["resolutions"][resolution]["raw"] = v
-                            s["maps"][map_name]["resolutions"][resolution]["renders"] = {}
-                            # use tuple for lru cache
-                            # may not be much of a benefit
-                            s["maps"][map_name]["resolutions"][resolution]["renders"]["vertical"] = visualize_map(map_raw=tuple(raw_map),
-                                                                                                resolution=int(resolution),
-                                                                                                cell_width=1,
-                                                                                                return_format="JPEG",
-                                                                                                return_image=True)
-                            s["maps"][map_name]["resolutions"][resolution]["renders"]["horizontal"] = visualize_map(map_raw=tuple(raw_map),
-                                                                                                  resolution=int(resolution),
-                                                                                                  columns="auto",
-                                                                                                  reverse_image=True,
-                                                                                                  return_format="JPEG",
-                                                                                                  return_image=True)
-            except KeyError:
-                pass
+                        s["maps"][map_name]["resolutions"][resolution]["renders"] = {}
+                        if map_name == "rgb_map":
+                            for render in ("vertical", "horizontal"):
+                                self.map_render(s["filehash"], map_name, resolution, render)
+                        else:
+                            # other colormaps share the rgb_map timeline and are
+                            # only rendered when shown as the active map
+                            self.map_index[(map_name, "resolution")] = (map_name, "resolution")
+        except KeyError:
+            pass
+
+    def map_render(self, filehash, map_name, resolution, render):
+        # render of a colormap, from the render cache if possible
+        resolution_data = self.sources[filehash]["maps"][map_name]["resolutions"][resolution]
+        if render not in resolution_data["renders"]:
+            digest = self.map_digest(resolution_data)
+            if render == "vertical":
+                # filehash, map, resolution, contents, render, cell width x height
+                render_key = (RENDER_CACHE_VERSION, filehash, map_name, resolution, digest, "vertical", "1x10", "jpg")
+                render_function = lambda: visualize_map(map_raw=self.get_frames(filehash, resolution, map_name=map_name),
+                                                        resolution=int(resolution),
+                                                        cell_width=1,
+                                                        return_format="JPEG",
+                                                        return_image=True)
+            else:
+                render_key = (RENDER_CACHE_VERSION, filehash, map_name, resolution, digest, "horizontal", "10x10", "jpg")
+                render_function = lambda: visualize_map(map_raw=self.get_frames(filehash, resolution, map_name=map_name),
+                                                        resolution=int(resolution),
+                                                        columns="auto",
+                                                        reverse_image=True,
+                                                        return_format="JPEG",
+                                                        return_image=True)
+            resolution_data["renders"][render] = self.render_cache.render(render_key, render_function)
+        return resolution_data["renders"][render]
+
+    def map_digest(self, resolution_data):
+        # identifies a map's contents so that renders of a
+        # regenerated map are not served from the render cache
+        if "raw" in resolution_data:
+            return hashlib.sha1(resolution_data["raw"].tobytes()).hexdigest()
+        manifest = resolution_data["manifest"]
+        if manifest.get("digest"):
+            return manifest["digest"]
+        return hashlib.sha1(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+
+    def get_frames(self, filehash, resolution, start=None, stop=None, map_name="rgb_map"):
+        # frames start to stop of a loaded source's map, chunked
+        # maps only fetch the chunks covering the range
+        resolution_data = self.sources[filehash]["maps"][map_name]["resolutions"][resolution]
+        if "raw" in resolution_data:
+            return resolution_data["raw"][start:stop]
+        manifest = resolution_data["manifest"]
+        start, stop, _ = slice(start, stop).indices(manifest["frames"])
+        if stop <= start:
+            return np.zeros((0, resolution, 3), dtype=np.uint8)
+        chunk_frames = manifest["chunk_frames"]
+        first = start // chunk_frames
+        last = (stop - 1) // chunk_frames
+        chunks = self.chunk_cache.get(resolution_data["chunk_key"], first, last, manifest)
+        offset = first * chunk_frames
+        return np.concatenate(chunks)[start - offset:stop - offset]
 
     def display_sources(self):
-        self.group_container.image_grid.clear_widgets()
+        # widgets are kept by (filehash, resolution, render) and only
+        # created, retextured or removed when their images change so
+        # that zoom and loop overlays survive source updates
+        image_grid = self.group_container.image_grid
+        # enlarge / shrink scale by 2 for each zoom_level step of 2
+        zoom_scale = 2 ** (self.group_container.scroller.zoom_level / 2)
+        displayed = []
+        new_images = []
         # sort sources
         for source, source_data in sorted(self.sources.items()):
+            try:
+                resolutions = source_data["maps"]["rgb_map"]["resolutions"]
+            except KeyError:
+                continue
             # sort by resolution
-            for resolution, resolution_data in sorted(source_data["maps"]["rgb_map"]["resolutions"].items()):
+            for resolution, resolution_data in sorted(resolutions.items()):
                 for render, image in resolution_data["renders"].items():
                     if render == self.render_as:
-                        # pass use_once to CoreImage
-                        use_once = io.BytesIO(image.read())
-                        image.seek(0)
-                        img = ClickableSourceImage(self)
-                        # store attributes for calculating row / column
-                        # to create loops
+                        active_map_image = self.active_map_image(source_data, resolution, render)
+                        key = (source_data["filehash"], resolution, render)
+                        img = self.source_images.get(key)
+                        if img is None:
+                            img = ClickableSourceImage(self)
+                            # store attributes for calculating row / column
+                            # to create loops
+                            img.filehash = source_data["filehash"]
+                            img.render = render
+                            img.resolution = resolution
+                            img.signature = None
+                            img.allow_stretch = True
+                            # important to set to (None, None) for expected scaling behavior
+                            img.size_hint = (None,None)
+                            self.source_images[key] = img
+                            new_images.append(img)
+
                         img.filename = source_data["filename"]
-                        img.filehash = source_data["filehash"]
-                        img.render = render
-                        img.resolution = resolution
-
-                        img.allow_stretch = True
-                        img.texture = CoreImage(use_once, ext="jpg").texture
-                        img.size = img.texture_size
-                        ww, hh= img.size
-                        if self.active_map:
-                            # always stretch active_maps to rgb_map dimensions
-                            try:
-                                map_name, map_page = self.map_index[self.active_map]
-                                ii = source_data["maps"][map_name]["images"][map_page]
-                                uu = io.BytesIO(ii.read())
-                                ii.seek(0)
-                                img.allow_stretch = True
-                                img.keep_ratio = False
-                                img.texture = CoreImage(uu, ext="jpg").texture
-                                img.width = ww
-                                img.height = hh
-                            except Exception as ex:
-                                print(ex)
-                                pass
-                        # important to set to (None, None) for expected scaling behavior
-                        img.size_hint = (None,None)
-                        self.group_container.image_grid.add_widget(img)
+                        signature = (image_digest(image), image_digest(active_map_image))
+                        if img.signature != signature:
+                            self.texture_source_image(img, image, active_map_image, zoom_scale)
+                            img.signature = signature
+                        displayed.append(img)
+
+        displayed_ids = set(id(img) for img in displayed)
+        for key, img in list(self.source_images.items()):
+            if id(img) not in displayed_ids:
+                del self.source_images[key]
+                image_grid.remove_widget(img)
+
+        # children are stored in reverse order of adding
+        if list(reversed(image_grid.children)) != displayed:
+            image_grid.clear_widgets()
+            for img in displayed:
+                image_grid.add_widget(img)
+
+        self.filehash_images = {}
+        for img in displayed:
+            self.filehash_images.setdefault(img.filehash, []).append(img)
+
+        # overlays for loops on new images
+        for loop in self.loops.values():
+            for img in new_images:
+                if img.filehash == loop.get('filehash'):
+                    self.draw_loop_overlay(img, loop)
+
+    def active_map_image(self, source_data, resolution=None, render=None):
+        # image maps are stretched over the rgb_map, colormaps
+        # are rendered at the rgb_map's resolution and layout
+        if self.active_map:
+            try:
+                map_name, map_page = self.map_index[self.active_map]
+                if "images" in source_data["maps"][map_name]:
+                    return source_data["maps"][map_name]["images"][map_page]
+                return self.map_render(source_data["filehash"], map_name, resolution, render)
+            except Exception as ex:
+                print(ex)
+        return None
+
+    def texture_source_image(self, img, image, active_map_image=None, zoom_scale=1):
+        # pass use_once to CoreImage
+        use_once = io.BytesIO(image.getvalue())
+        img.keep_ratio = True
+        img.texture = CoreImage(use_once, ext="jpg").texture
+        ww, hh = img.texture_size
+        ww *= zoom_scale
+        hh *= zoom_scale
+        if active_map_image is not None:
+            # always stretch active_maps to rgb_map dimensions
+            uu = io.BytesIO(active_map_image.getvalue())
+            img.keep_ratio = False
+            img.texture = CoreImage(uu, ext="jpg").texture
+        img.width = ww
+        img.height = hh
+        img.redraw_overlays()
 
     def display_traces(self, trace_key):
         trace = redis_conn.hgetall(trace_key)
@@ -1067,26 +1387,40 @@ class VzzGuiApp(App):
         return root
 
     def handle_db_events(self, message):
-        # this is being called from a different thread and causing
-        # issues?
-        # use kivy Clock to schedule once instead of calling directly
-        if ":source:" in message["channel"]:
-            Clock.schedule_once(lambda dt: self.update_sources())
-            Clock.schedule_once(lambda dt: self.display_sources())
-        elif ":focus:" in message["channel"]:
-            # focus / traces are independent of server
-            # since gui may be combining from several servers
-            print(message)
-            # behavior stills seems problematic
-            # speed of callbacks and delays in clock scheduling?
-            trace_key = message["channel"].replace("__keyspace@0__:","")
-            # self.display_traces(trace_key)
-            Clock.schedule_once(lambda dt, trace_key=trace_key: self.display_traces(trace_key))
-        elif ":loop:" in message["channel"]:
-            print("update?",message)
-            # need to change update_loops to update loops instead
-            # of clear / recreate from db
-            Clock.schedule_once(lambda dt: self.update_loops())
+        # this is being called from the pubsub thread, collect
+        # changed keys and use a kivy Clock trigger so that a
+        # burst of events becomes a single refresh
+        key = message["channel"].replace("__keyspace@0__:","")
+        with self.db_events_lock:
+            self.db_changed_keys.add(key)
+        self.db_events_trigger()
+
+    def refresh_changed(self, dt):
+        with self.db_events_lock:
+            changed_keys = self.db_changed_keys
+            self.db_changed_keys = set()
+
+        source_keys = set()
+        loop_keys = set()
+        for key in changed_keys:
+            if is_source_key(key):
+                source_keys.add(key)
+            elif key.startswith("source:"):
+                # chunks are written with their
+                # manifest in source:<hash>
+                pass
+            elif key.startswith("focus:"):
+                # focus / traces are independent of server
+                # since gui may be combining from several servers
+                self.display_traces(key)
+            elif ":loop:" in key:
+                loop_keys.add(key)
+
+        if source_keys:
+            self.update_sources(source_keys)
+            self.display_sources()
+        if loop_keys:
+            self.update_loops(loop_keys)
 
     def _keyboard_closed(self):
         # do not unbind the keyboard because
@@ -1204,14 +1538,15 @@ class VzzGuiApp(App):
         if filehash:
             loop['filehash'] = filehash
 
-        redis_conn.hmset("vizaviz:{server}:loop:{loop_id}".format(server="foo", loop_id=loop['uuid']), loop)
+        loop_key = "vizaviz:{server}:loop:{loop_id}".format(server="foo", loop_id=loop['uuid'])
+        redis_conn.hmset(loop_key, loop)
         # overlay focus fov zoomfactor, windowx windowy
         # static/dynamic annotations?
         focus_trace = "focus:{name}".format(name=self.focus_name)
         redis_conn.hmset(focus_trace, {"filename":filename, "start":start, "end":end})
         redis_conn.expire(focus_trace, 30)
         # update gui
-        self.update_loops()
+        self.update_loops([loop_key])
 
 class ClickableSourceImage(Image):
     def __init__(self, app, **kwargs):
@@ -1237,8 +1572,9 @@ class ClickableSourceImage(Image):
         self.redraw_overlays()
 
     def redraw_overlays(self):
-        for _, overlay in self.overlays.items():
-            self.draw_loop(*overlay)
+        # overlays are stored as draw_overlay's arguments
+        for overlay in list(self.overlays.values()):
+            self.draw_overlay(*overlay)
 
     @property
     def width_scaled(self):
@@ -1265,7 +1601,7 @@ class ClickableSourceImage(Image):
         h = end - start
         with self.canvas:
             self.canvas.remove_group(uuid)
-            Color(1, 1, 1, 0.5)
+            Color(1, 1, 1, 0.5, group=uuid)
             Line(rectangle=(x, y, w, h), fill=(0, 0, 0, 0), width=3, group=uuid)
 
     def on_touch_up(self, touch):
@@ -1323,6 +1659,7 @@ if __name__ == "__main__":
     parser.add_argument("--port", default=6379)
     parser.add_argument("--auth", default="")
     parser.add_argument("--focus-name", default="")
+    parser.add_argument("--render-cache-mb", default=512, type=int)
 
     args = parser.parse_args()
 
@@ -0,0 +1,96 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import os
+import struct
+import ctypes
+import ctypes.util
+
+# see inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct("iIII")
+
+class Inotify(object):
+    """Recursive directory watcher using the linux inotify api
+
+    raises OSError if inotify is not available
+    """
+    def __init__(self):
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        except AttributeError:
+            raise OSError("inotify not available")
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        # watch descriptor : directory
+        self.watches = {}
+
+    def add_watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(str(directory)), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), str(directory))
+        self.watches[wd] = str(directory)
+
+    def add_tree(self, directory):
+        # watch directory and its subdirectories, returns
+        # the files already in the tree
+        files = []
+        for root, _, filenames in os.walk(str(directory)):
+            try:
+                self.add_watch(root)
+            except OSError:
+                # removed while walking
+                continue
+            files.extend(os.path.join(root, filename) for filename in filenames)
+        return files
+
+    def read(self):
+        """Block until events are available
+
+        returns a list of (path, mask) tuples, new
+        directories are watched as they appear
+        """
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + name_length].rstrip(b"\0")
+            offset += name_length
+
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+
+            if mask & IN_Q_OVERFLOW or wd not in self.watches:
+                events.append((None, mask))
+                continue
+
+            path = os.path.join(self.watches[wd], os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # report files of directories created or
+                    # moved into the tree as moved in
+                    for file in self.add_tree(path):
+                        events.append((file, IN_MOVED_TO))
+            else:
+                events.append((path, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)